@@ -4,7 +4,6 @@ Sample script to demonstrate the PDF Knowledge Assistant API usage
 """
 
 import requests
-import time
 import sys
 import json
 from rich.console import Console
@@ -14,11 +13,13 @@ def main():
     # Configure API endpoint
     base_url = "http://localhost:8000"
     console = Console()
+    # Reuse one keep-alive connection for every request
+    session = requests.Session()
 
     # Check API status
     console.print("[yellow]Checking API status...[/yellow]")
     try:
-        response = requests.get(f"{base_url}/status")
+        response = session.get(f"{base_url}/status")
         status_data = response.json()
         console.print(f"[green]API Status: {status_data['status']}[/green]")
         console.print(f"[green]Message: {status_data['message']}[/green]")
@@ -31,7 +32,7 @@ def main():
     if status_data['status'] != "ready":
         console.print("\n[yellow]Knowledge base is not ready. Triggering PDF processing...[/yellow]")
         try:
-            response = requests.post(
+            response = session.post(
                 f"{base_url}/process-pdfs",
                 json={"force_rebuild": False}
             )
@@ -42,18 +43,25 @@ def main():
             # If processing started, wait for it to complete
             if process_data['status'] == "processing":
                 console.print("\n[yellow]Waiting for processing to complete. This may take some time...[/yellow]")
-                time.sleep(5)  # Wait a bit before checking status again
 
-                # Check status repeatedly until ready
-                while True:
-                    response = requests.get(f"{base_url}/status")
-                    status_data = response.json()
-                    if status_data['status'] == "ready":
+                # Only needed here, so the other checks still run without sseclient-py installed
+                import sseclient
+
+                # Follow progress over one SSE connection instead of polling /status
+                response = session.get(f"{base_url}/events", stream=True)
+                client = sseclient.SSEClient(response)
+                for event in client.events():
+                    if event.data == "ready":
                         console.print("[green]Knowledge base is now ready![/green]")
                         break
+                    elif event.data == "not_ready" or event.data.startswith("error:"):
+                        console.print(f"[red]Processing failed: {event.data}[/red]")
+                        sys.exit(1)
+                    elif event.data.startswith("processed:"):
+                        console.print(f"[yellow]Extracted {event.data[len('processed:'):]} chunks, building knowledge base...[/yellow]")
                     else:
                         console.print("[yellow]Still processing...[/yellow]")
-                        time.sleep(5)  # Check every 5 seconds
+                response.close()
         except Exception as e:
             console.print(f"[red]Error processing PDFs: {e}[/red]")
             sys.exit(1)
@@ -70,7 +78,7 @@ def main():
     for question in questions:
         console.print(f"\n[bold blue]Question: {question}[/bold blue]")
         try:
-            response = requests.post(
+            response = session.post(
                 f"{base_url}/query",
                 json={"query": question}
             )
@@ -99,7 +107,7 @@ def main():
             continue
 
         try:
-            response = requests.post(
+            response = session.post(
                 f"{base_url}/query",
                 json={"query": query}
             )
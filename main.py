@@ -10,12 +10,9 @@ import typer
 from typing import Optional, List
 from pathlib import Path
 import os
+import logging
 
 from src.pdf_processor import PDFProcessor
-from src.knowledge_base import KnowledgeBase
-from src.chat_interface import ChatInterface
-
-import uvicorn
 
 app = typer.Typer()
 
@@ -25,6 +22,9 @@ def process_pdfs(
     force_rebuild: bool = typer.Option(False, help="Force rebuild of knowledge base even if embeddings exist")
 ):
     """Process PDFs and build a knowledge base for querying"""
+    # Imported per command: spawned PDF workers re-run this module's top-level imports
+    from src.knowledge_base import KnowledgeBase
+
     processor = PDFProcessor()
     kb = KnowledgeBase()
 
@@ -40,9 +40,17 @@ def process_pdfs(
     typer.echo(f"Processing PDFs from {pdf_dir}...")
     documents = processor.process_directory(pdf_dir)
     typer.echo(f"Processed {len(documents)} documents")
+    if not documents:
+        typer.echo("No text could be extracted from the PDFs; the knowledge base was not changed.")
+        return
 
     typer.echo("Building knowledge base...")
-    kb.add_documents(documents, force_rebuild=force_rebuild)
+    kb.add_documents_batched(
+        [doc.page_content for doc in documents],
+        [doc.metadata for doc in documents],
+        batch_size=64,
+        force_rebuild=force_rebuild
+    )
     typer.echo("Knowledge base built successfully!")
 
 @app.command()
@@ -58,9 +66,16 @@ def chat(
     web: bool = typer.Option(
         False,
         help="Launch web interface instead of terminal chat"
+    ),
+    quant: str = typer.Option(
+        "Q4_K_M",
+        help="Quantization of the default model to download (e.g. Q4_K_M, Q5_K_M, Q3_K_S)"
     )
 ):
     """Start an interactive chat session with the knowledge base"""
+    if debug:
+        logging.basicConfig(level=logging.DEBUG)
+    from src.knowledge_base import KnowledgeBase
     kb = KnowledgeBase()
 
     chat_interface = None
@@ -73,10 +88,13 @@ def chat(
     if web:
         # Start the web interface using the API server
         typer.echo("Starting web interface...")
+        import uvicorn
         uvicorn.run("src.api:app", host="127.0.0.1", port=8000)
     else:
         import asyncio
-        chat_interface = ChatInterface(kb, model_path, debug=debug)
+        # Imported here so other commands don't pay for loading llama.cpp and LangChain's LLM stack
+        from src.chat_interface import ChatInterface
+        chat_interface = ChatInterface(kb, model_path, debug=debug, model_quant=quant, silence_native_logs=True)
         # Run the async function with asyncio.run()
         asyncio.run(chat_interface.start_interactive_chat())
 
@@ -84,12 +102,20 @@ def chat(
 def api_server(
     host: str = typer.Option("0.0.0.0", help="Host address to bind the API server"),
     port: int = typer.Option(8000, help="Port to bind the API server"),
-    reload: bool = typer.Option(False, help="Enable auto-reload for development")
+    reload: bool = typer.Option(False, help="Enable auto-reload for development"),
+    workers: int = typer.Option(1, help="Number of worker processes (not compatible with --reload)")
 ):
     """Start the REST API server"""
+    if workers > 1:
+        # Workers read this to memory-map a shared FAISS index
+        os.environ["API_WORKERS"] = str(workers)
+        # Each worker loads its own LLM, so keep them off the GPU unless layers are set explicitly
+        os.environ.setdefault("N_GPU_LAYERS", "0")
+
     typer.echo(f"Starting API server at http://{host}:{port}")
     typer.echo("Press CTRL+C to stop the server")
-    uvicorn.run("src.api:app", host=host, port=port, reload=reload)
+    import uvicorn
+    uvicorn.run("src.api:app", host=host, port=port, reload=reload, workers=workers)
 
 @app.callback()
 def callback():
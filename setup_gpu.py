@@ -11,7 +11,8 @@ def main():
     print("Starting setup for GPU-enabled llama-cpp-python...")
 
     # Set environment variables for CUDA support
-    os.environ["CMAKE_ARGS"] = "-DGGML_CUDA=on"
+    # F16 CUDA kernels let cuBLAS use tensor cores on RTX/A100-class GPUs
+    os.environ["CMAKE_ARGS"] = "-DGGML_CUDA=on -DGGML_CUDA_F16=on"
     os.environ["FORCE_CMAKE"] = "1"
 
     # Uninstall existing package
@@ -51,7 +52,7 @@ def main():
 
     print("\nSetup complete. If GPU support is shown as available, you should now be able to use GPU acceleration.")
     print("If you still have issues, ensure your NVIDIA drivers are up to date.")
-    print("\nTo use GPU acceleration, make sure n_gpu_layers is set to a value between 1 and the total number of layers (-1 for all).")
+    print("\nAll layers are offloaded to the GPU by default. Set N_GPU_LAYERS to offload fewer (0 for CPU only).")
 
 if __name__ == "__main__":
     main()
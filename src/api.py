@@ -3,14 +3,17 @@ API module for the PDF Knowledge Assistant with true streaming support
 """
 
 import os
+import time
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse, Response
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set, Tuple
 
 from src.pdf_processor import PDFProcessor
 from src.knowledge_base import KnowledgeBase
@@ -24,68 +27,193 @@ class ProcessPDFRequest(BaseModel):
     force_rebuild: bool = False
 
 # Initialize FastAPI app
-app = FastAPI(title="PDF Knowledge Assistant API")
+app = FastAPI(title="PDF Knowledge Assistant API", default_response_class=ORJSONResponse)
+
+# Each worker process holds its own copies of the globals below
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
 
 # Global variables
 kb = None
 chat_interface = None
+_pdf_scan_cache: Dict[str, Tuple[float, bool]] = {}
+_init_lock: Optional[asyncio.Lock] = None
+ingest_in_progress = False
+_progress_subscribers: Set[asyncio.Queue] = set()
+# Token streams wait here for the model instead of holding default-executor threads that
+# asyncio.to_thread needs for /status, index reloads and cache lookups
+_llm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-stream")
+
+def _pdf_dir_has_pdfs(pdf_dir: str, ttl: float = 2.0) -> bool:
+    """Check whether a directory contains any PDFs, caching the answer for a short TTL"""
+    now = time.monotonic()
+    cached = _pdf_scan_cache.get(pdf_dir)
+    if cached and now - cached[0] < ttl:
+        return cached[1]
+
+    # A single scandir pass stops at the first PDF and reuses the dirent type info
+    with os.scandir(pdf_dir) as entries:
+        has_pdfs = any(entry.name.lower().endswith('.pdf') and entry.is_file() for entry in entries)
+
+    _pdf_scan_cache[pdf_dir] = (now, has_pdfs)
+    return has_pdfs
+
+async def _ensure_chat_interface() -> ChatInterface:
+    """Create the shared chat interface once, loading the model off the event loop"""
+    global chat_interface, _init_lock
+    if chat_interface is not None:
+        return chat_interface
+
+    # Created lazily so the lock binds to the server's running loop
+    if _init_lock is None:
+        _init_lock = asyncio.Lock()
+
+    async with _init_lock:
+        # Concurrent first requests wait here instead of loading the model twice
+        if chat_interface is None:
+            loop = asyncio.get_running_loop()
+            interface = await loop.run_in_executor(None, ChatInterface, kb)
+            # Prime llama.cpp and FAISS before the first user query arrives
+            await asyncio.to_thread(interface.warmup)
+            chat_interface = interface
+    return chat_interface
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize knowledge base and chat interface on startup"""
-    global kb, chat_interface
+    global kb
     print("Starting PDF Knowledge Assistant API...")
-    kb = KnowledgeBase()
+    # Worker processes share one memory-mapped index instead of each loading a copy
+    kb = KnowledgeBase(mmap_index=API_WORKERS > 1)
     if kb.check_knowledge_base_exists():
         print("Knowledge base found, initializing chat interface...")
-        chat_interface = ChatInterface(kb)
+        await _ensure_chat_interface()
         print(f"Chat interface initialized: {chat_interface is not None}")
     else:
         print("No knowledge base found, waiting for /process-pdfs call")
 
+class StaticFilesCached(StaticFiles):
+    """Static files that browsers may cache, revalidating with ETag/If-None-Match."""
+
+    def file_response(self, *args, **kwargs) -> Response:
+        # StaticFiles already sets an mtime+size ETag and answers matching requests with 304
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=3600"
+        return response
+
 # Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", StaticFilesCached(directory="static", html=True), name="static")
+
+# Read once at import; the page is requested on every browser reconnect
+_INDEX_HTML = Path("static/index.html").read_bytes()
 
 @app.get("/")
 async def root():
     """Serve the main HTML page"""
-    return FileResponse("static/index.html")
+    return Response(content=_INDEX_HTML, media_type="text/html")
 
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # For development - restrict in production
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    # Only the methods and headers the web UI and API clients use, instead of allowing any
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Accept", "Cache-Control"],
 )
 
+_SSE_DONE = b"data: [DONE]\n\n"
+
+def _format_sse(data: str, buf: Optional[bytearray] = None) -> bytes:
+    """
+    Encode text as a single SSE event, keeping embedded newlines intact.
+
+    Args:
+        data: Event payload
+        buf: Optional scratch buffer reused across events of one stream
+
+    Returns:
+        The encoded event
+    """
+    if buf is None:
+        buf = bytearray()
+    buf.clear()
+    buf += b"data: "
+    buf += data.encode("utf-8").replace(b"\n", b"\ndata: ")
+    buf += b"\n\n"
+    return bytes(buf)
+
+async def _iterate_in_thread(iterator, executor: Optional[ThreadPoolExecutor] = None):
+    """Drive a blocking iterator on executor (the default one if None), yielding its items on the event loop"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            # Skip the work entirely if the client left while this waited for the executor
+            if not stop.is_set():
+                for item in iterator:
+                    if stop.is_set():  # Client went away
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+        finally:
+            # Closing the generator releases the model lock held inside it
+            close = getattr(iterator, "close", None)
+            if close:
+                close()
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    future = loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            yield item
+        await future  # Re-raise errors from the worker thread
+    finally:
+        stop.set()
+
 async def stream_chat_response(message: str):
     """Generate true streaming response from chat interface"""
+    # Scratch buffer reused for every event in this stream
+    buf = bytearray()
     try:
-        # Track sources during streaming
-        collected_sources = []
-
-        # Use the new streaming response method
-        async for token, sources in chat_interface.get_streaming_response(message):
-            # Send each token as it's generated
-            yield f"data: {token}\n\n"
-            # Remember the sources
-            if sources and not collected_sources:
-                collected_sources = sources
-            # Small delay to prevent overwhelming the client
-            await asyncio.sleep(0.01)
+        # Embed the question off the event loop for the semantic cache lookup
+        query_embedding = await asyncio.to_thread(kb.embedding_model.embed_query, message)
+        cached = await asyncio.to_thread(chat_interface.lookup_cached_response, query_embedding)
+
+        if cached:
+            answer, collected_sources = cached
+            yield _format_sse(answer, buf)
+        else:
+            # Track tokens during streaming
+            tokens = []
+
+            # Retrieve and start decoding without going through the LangChain chain
+            token_iterator, collected_sources = await asyncio.to_thread(
+                chat_interface.fast_query, message, query_embedding
+            )
+            async for token in _iterate_in_thread(token_iterator, _llm_executor):
+                # Send each token as it's generated
+                yield _format_sse(token, buf)
+                tokens.append(token)
+
+            await asyncio.to_thread(
+                chat_interface.semantic_cache.add, query_embedding, "".join(tokens), collected_sources
+            )
 
         # Send sources in a standardized format as the last message before DONE
         if collected_sources:
-            yield f"data: SOURCES:{', '.join(collected_sources)}\n\n"
+            yield _format_sse(f"SOURCES:{', '.join(collected_sources)}", buf)
 
         # Signal that the stream is complete
-        yield "data: [DONE]\n\n"
+        yield _SSE_DONE
     except Exception as e:
         error_msg = str(e)
-        yield f"data: Error: {error_msg}\n\n"
-        yield "data: [DONE]\n\n"
+        yield _format_sse(f"Error: {error_msg}", buf)
+        yield _SSE_DONE
 
 @app.post("/api/chat-stream")
 async def chat_stream(query: QueryRequest):
@@ -100,7 +228,10 @@ async def chat_stream_get(message: str):
 async def handle_chat_stream(message: str):
     """Common handler for both POST and GET endpoints"""
     try:
-        if not chat_interface:
+        # Pick up an index saved by the process-pdfs command or another process
+        await asyncio.to_thread(kb.reload_if_changed)
+
+        if not chat_interface and not kb.check_knowledge_base_exists():
             return StreamingResponse(
                 iter([
                     "data: Knowledge base not initialized. Please process PDFs first by adding PDFs to the data/pdfs directory and calling the /process-pdfs endpoint.\n\n",
@@ -117,6 +248,8 @@ async def handle_chat_stream(message: str):
                 ]),
                 media_type="text/event-stream"
             )
+
+        await _ensure_chat_interface()
         return StreamingResponse(
             stream_chat_response(message),
             media_type="text/event-stream"
@@ -133,43 +266,109 @@ async def handle_chat_stream(message: str):
 @app.get("/status")
 async def get_status():
     """Check if the knowledge base is ready"""
+    if ingest_in_progress:
+        return {"status": "processing", "message": "PDFs are being processed"}
+
+    await asyncio.to_thread(kb.reload_if_changed)
     is_ready = kb.check_knowledge_base_exists()
     return {
         "status": "ready" if is_ready else "not_ready",
         "message": "Knowledge base is ready for queries" if is_ready else "Please process PDFs first"
     }
 
+def _publish_progress(event: str) -> None:
+    """Send a processing progress event to every /events subscriber"""
+    for queue in _progress_subscribers:
+        queue.put_nowait(event)
+
+async def _do_ingest(pdf_dir: str, force_rebuild: bool) -> None:
+    """Process PDFs and build the knowledge base in worker threads"""
+    global ingest_in_progress
+    try:
+        processor = PDFProcessor()
+        documents = await asyncio.to_thread(processor.process_directory, pdf_dir)
+        _publish_progress(f"processed:{len(documents)}")
+        if not documents:
+            # Every PDF failed or held no extractable text (e.g. scanned pages); any existing index is kept
+            print("No text chunks extracted from the PDFs; the knowledge base was not changed")
+            _publish_progress("error:no documents")
+            return
+
+        await asyncio.to_thread(
+            kb.add_documents_batched,
+            [doc.page_content for doc in documents],
+            [doc.metadata for doc in documents],
+            batch_size=64,
+            force_rebuild=force_rebuild
+        )
+
+        if kb.vector_store is None:
+            _publish_progress("error:no documents")
+            return
+
+        # Initialize chat interface after processing (reused if already loaded)
+        await _ensure_chat_interface()
+        print(f"Processed {len(documents)} documents")
+        _publish_progress("ready")
+    except Exception as e:
+        print(f"Error processing PDFs: {str(e)}")
+        _publish_progress(f"error:{str(e)}")
+    finally:
+        ingest_in_progress = False
+
 @app.post("/process-pdfs")
 async def process_pdfs(request: ProcessPDFRequest, background_tasks: BackgroundTasks):
     """Process PDFs in the background"""
-    global chat_interface
-    processor = PDFProcessor()
+    global ingest_in_progress
     pdf_dir = "data/pdfs"
 
     # Create PDF directory if it doesn't exist
     os.makedirs(pdf_dir, exist_ok=True)
 
-    if not any(Path(pdf_dir).glob('*.pdf')):
+    if API_WORKERS > 1:
+        # Workers can't see each other's ingest state and would race on saving the index
+        raise HTTPException(
+            status_code=409,
+            detail="PDF processing is disabled with multiple workers. Run 'python main.py process-pdfs'; "
+                   "workers load the new index automatically."
+        )
+
+    if not _pdf_dir_has_pdfs(pdf_dir):
         raise HTTPException(
             status_code=400,
             detail=f"No PDFs found in {pdf_dir}. Please add PDFs to this directory."
         )
 
-    # Process PDFs and build knowledge base
-    documents = processor.process_directory(pdf_dir)
-    kb.add_documents(documents, force_rebuild=request.force_rebuild)
+    if ingest_in_progress:
+        return {"status": "processing", "message": "PDF processing is already in progress"}
 
-    # Initialize chat interface after processing
-    chat_interface = ChatInterface(kb)
+    # Return immediately; the event loop stays free while PDFs are processed
+    ingest_in_progress = True
+    _publish_progress("processing")
+    background_tasks.add_task(_do_ingest, pdf_dir, request.force_rebuild)
 
-    # Verify initialization was successful
-    if not chat_interface or not kb.check_knowledge_base_exists():
-        raise HTTPException(
-            status_code=500,
-            detail="Failed to initialize chat interface after processing PDFs."
-        )
+    return {"status": "processing", "message": f"Processing PDFs from {pdf_dir}"}
+
+@app.get("/events")
+async def events():
+    """Stream PDF processing progress as server-sent events"""
+    queue = asyncio.Queue()
+    _progress_subscribers.add(queue)
+
+    async def generate():
+        try:
+            # Start with the current state so subscribers never miss a run that already finished
+            if ingest_in_progress:
+                yield _format_sse("processing")
+            else:
+                yield _format_sse("ready" if kb.check_knowledge_base_exists() else "not_ready")
+
+            while True:
+                yield _format_sse(await queue.get())
+        finally:
+            _progress_subscribers.discard(queue)
 
-    return {"status": "success", "message": f"Processed {len(documents)} documents"}
+    return StreamingResponse(generate(), media_type="text/event-stream")
 
 # Add a test streaming endpoint
 @app.get("/test-stream")
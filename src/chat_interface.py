@@ -3,48 +3,121 @@ Enhanced chat interface module with true streaming support
 """
 
 import os
+import sys
+import atexit
 import asyncio
-from typing import List, Optional, AsyncIterator, Generator, Tuple
+import threading
+import numpy as np
+import psutil
+from typing import List, Optional, Generator, Iterator, Sequence, Tuple
 from rich.console import Console
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_community.llms import LlamaCpp
-from langchain.callbacks.manager import CallbackManager
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
+from llama_cpp import LlamaRAMCache
 from huggingface_hub import hf_hub_download
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.messages import HumanMessage, AIMessage
-from contextlib import redirect_stderr
-
-# Custom streaming callback handler that yields tokens
-class StreamingCallbackHandler(StreamingStdOutCallbackHandler):
-    def __init__(self):
-        super().__init__()
-        self.tokens = []
-        self.queue = asyncio.Queue()
-
-    def on_llm_new_token(self, token: str, **kwargs) -> None:
-        # Don't print to stdout
-        self.tokens.append(token)
-        # Add token to the queue for async consumption
-        self.queue.put_nowait(token)
-
-    def on_llm_end(self, *args, **kwargs) -> None:
-        # Signal that LLM generation is complete
-        self.queue.put_nowait(None)
-
-    async def get_tokens(self) -> AsyncIterator[str]:
-        # Yield tokens as they become available
-        while True:
-            token = await self.queue.get()
-            if token is None:  # End signal
-                break
-            yield token
+from contextlib import contextmanager, nullcontext
 
+from src.semantic_cache import SemanticCache
+
+try:
+    import readline  # Line editing and up-arrow history for input(); pyreadline3 provides it on Windows
+except ImportError:
+    readline = None
+
+# Number of question/answer exchanges kept in the chat history
+MAX_HISTORY_TURNS = 8
+# Console input history, kept across sessions and trimmed to the most recent entries when saved
+INPUT_HISTORY_FILE = os.path.expanduser("~/.pdf_kb_history")
+INPUT_HISTORY_LENGTH = 1000
+# Passed to input() so readline knows where the editable text starts; \001/\002 tell it the
+# color codes take no screen width, otherwise edits and history recall redraw at the wrong column
+INPUT_PROMPT = "\001\033[1;34m\002You:\001\033[0m\002 " if readline is not None else "You: "
+
+# Parsed once at import and shared by every ChatInterface
+QA_TEMPLATE = """You are a helpful PDF Knowledge Assistant that provides accurate information from documents.
+
+Here is the relevant information:
+---------------------
+{context}
+---------------------
+
+Answer the question using only the information provided above. Do not:
+- Start with "Based on..." or reference the context
+- Rephrase the question
+- Start with a question
+
+Question: {question}
+Answer: """
+
+QA_PROMPT = PromptTemplate(
+    template=QA_TEMPLATE,
+    input_variables=["context", "question"]
+)
+
+@contextmanager
+def _suppress_c_stderr():
+    """Point file descriptor 2 at /dev/null so native llama.cpp/GGML logging is silenced too"""
+    sys.stderr.flush()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    saved = os.dup(2)
+    os.dup2(devnull, 2)
+    os.close(devnull)
+    try:
+        yield
+    finally:
+        sys.stderr.flush()
+        os.dup2(saved, 2)
+        os.close(saved)
+
+def _gpu_layers() -> int:
+    """Number of layers to offload to the GPU (-1 for all), overridable via N_GPU_LAYERS"""
+    layers = os.getenv("N_GPU_LAYERS")
+    if layers is not None:
+        return int(layers)
+    # Only request offload when llama-cpp-python was built with a GPU backend
+    try:
+        from llama_cpp import llama_supports_gpu_offload
+        return -1 if llama_supports_gpu_offload() else 0
+    except Exception:
+        return 0
+
+def _cpu_threads() -> int:
+    """llama.cpp thread count: one per physical core, capped where scaling flattens out"""
+    # SMT siblings share a core's execution units, so logical CPUs would oversubscribe decode
+    return min(16, psutil.cpu_count(logical=False) or os.cpu_count() or 8)
+
+def _kv_cache_bytes() -> int:
+    """RAM budget for saved KV states, from KV_CACHE_BYTES (0, the default, disables the cache)"""
+    return int(os.getenv("KV_CACHE_BYTES", "0"))
+
+def _should_mlock(model_path: str, reserved_bytes: int = 0) -> bool:
+    """Pin the weights in RAM only when there is comfortable headroom for them beyond reserved_bytes"""
+    return psutil.virtual_memory().available - reserved_bytes > os.path.getsize(model_path) * 1.5
+
+def _unique_sources(docs) -> List[str]:
+    """Source filenames of the documents, deduplicated in first-seen (relevance) order"""
+    return list(dict.fromkeys(doc.metadata["source"] for doc in docs if "source" in doc.metadata))
+
+# Defensive bound on each chunk's share of the prompt; PDF chunks never exceed the
+# embedder's ~1000-character window, so this only trims text indexed from elsewhere
+MAX_CHUNK_CHARS = 1000
+
+def _format_context(docs) -> str:
+    """Join retrieved chunks into the prompt context, truncating oversized ones"""
+    # A list lets str.join size the result in one pass instead of materializing a generator
+    return "\n\n".join([doc.page_content[:MAX_CHUNK_CHARS] for doc in docs])
 
 class ChatInterface:
     """Enhanced interface for chatting with the knowledge base using a local LLM with streaming support."""
-    def __init__(self, knowledge_base, model_path: Optional[str] = None, debug: bool = False):
+    qa_template = QA_TEMPLATE
+    qa_prompt = QA_PROMPT
+
+    def __init__(self, knowledge_base, model_path: Optional[str] = None, debug: bool = False,
+                 cache_threshold: float = 0.92, cache_size: int = 5000, model_quant: str = "Q4_K_M",
+                 kv_cache_bytes: Optional[int] = None, silence_native_logs: bool = False):
         """
         Initialize the chat interface with a knowledge base and optional model path.
 
@@ -52,36 +125,33 @@ class ChatInterface:
             knowledge_base: The knowledge base to query
             model_path: Optional path to local LLM model (downloads model if not provided)
             debug: Whether to show debug information like performance metrics
+            cache_threshold: Cosine similarity above which a previous answer is reused
+            cache_size: Maximum number of answers kept in the semantic cache
+            model_quant: Quantization of the default model to download (e.g. Q4_K_M, Q5_K_M, Q3_K_S)
+            kv_cache_bytes: RAM budget for saved KV states reused across prompts with a shared prefix
+                (defaults to KV_CACHE_BYTES; 0 disables it, otherwise each completion also pays to copy
+                its KV state out of the context)
+            silence_native_logs: Discard llama.cpp's stderr output while loading; fd 2 is process-wide,
+                so only single-threaded callers like the console chat should enable it
         """
         self.knowledge_base = knowledge_base
         self.console = Console()
         self.debug = debug
+        self.silence_native_logs = silence_native_logs and not debug
+        self.model_quant = model_quant
+        self.kv_cache_bytes = _kv_cache_bytes() if kv_cache_bytes is None else kv_cache_bytes
         self.model_path = self._get_model_path(model_path)
-        # Use a custom non-printing callback handler to prevent duplicate output
-        self.callback_handler = StreamingCallbackHandler()
+        # One model serves get_response (via LangChain) and fast_query (streaming from llama.cpp directly)
         self.llm = self._load_llm()
-        self.streaming_llm = None  # Will be initialized on demand
+        # llama.cpp contexts aren't thread-safe; serialize every call into the model
+        self._llm_lock = threading.Lock()
         self.current_source_docs = []  # Track current source documents
         self.message_history = ChatMessageHistory()
-        # Create prompt template
-        self.qa_template = """You are a helpful PDF Knowledge Assistant that provides accurate information from documents.
-
-Here is the relevant information:
----------------------
-{context}
----------------------
-
-Answer the question using only the information provided above. Do not:
-- Start with "Based on..." or reference the context
-- Rephrase the question
-- Start with a question
-
-Question: {question}
-Answer: """
-
-        self.qa_prompt = PromptTemplate(
-            template=self.qa_template,
-            input_variables=["context", "question"]
+        # Paraphrased repeats of earlier questions are answered without calling the LLM
+        self.semantic_cache = SemanticCache(
+            threshold=cache_threshold,
+            max_entries=cache_size,
+            persist_dir=os.path.join("data", "embeddings", "semantic_cache")
         )
 
     def _get_model_path(self, model_path: Optional[str]) -> str:
@@ -99,7 +169,9 @@ Answer: """
 
         # Default model if none provided
         model_name = "TheBloke/Mistral-7B-Instruct-v0.2-GGUF"
-        model_filename = "mistral-7b-instruct-v0.2.Q4_K_M.gguf"
+        # Decoding reads every weight once per token, so 4-bit weights roughly halve
+        # memory traffic versus 8-bit. Q5_K_M trades speed for quality, Q3_K_S the reverse.
+        model_filename = f"mistral-7b-instruct-v0.2.{self.model_quant}.gguf"
 
         # Path to save the model
         models_dir = os.path.join("data", "models")
@@ -128,59 +200,61 @@ Answer: """
         """
         self.console.print("[yellow]Loading LLM model... This may take a minute...[/yellow]")
 
-        # Create a standard callback manager
-        callback_manager = CallbackManager([self.callback_handler])
-
-        # Create a null device to discard stderr output temporarily
-        with open(os.devnull, 'w') as null_stderr:
-            with redirect_stderr(null_stderr):
-                llm = LlamaCpp(
-                    model_path=self.model_path,
-                    temperature=0.1,
-                    max_tokens=2048,
-                    n_ctx=32768,  # Reduced context size to prevent memory issues
-                    top_p=0.95,
-                    callback_manager=callback_manager,
-                    verbose=self.debug,  # Only show performance metrics in debug mode
-                    n_gpu_layers=-1,  # CPU-only mode to ensure compatibility
-                    n_batch=512,  # Batch size for efficiency
-                    f16_kv=True,  # Use half-precision for key/value cache
-                    seed=42  # Fixed seed for reproducibility
-                    # Removed potentially problematic parameters
-                )
+        # Discard native stderr output while loading, only when the caller owns the whole process
+        with _suppress_c_stderr() if self.silence_native_logs else nullcontext():
+            llm = LlamaCpp(
+                model_path=self.model_path,
+                temperature=0.1,
+                max_tokens=2048,
+                n_ctx=4096,  # Fits the retrieved context plus the answer without a huge KV cache
+                top_p=0.95,
+                verbose=self.debug,  # Only show performance metrics in debug mode
+                n_gpu_layers=_gpu_layers(),  # Offload every layer to cuBLAS/tensor cores when built with CUDA
+                n_threads=_cpu_threads(),  # Decode threads matched to the machine
+                n_batch=2048,  # Prefill a whole multi-chunk RAG prompt in as few passes as possible
+                model_kwargs={"n_threads_batch": _cpu_threads()},  # Prompt-eval threads
+                use_mmap=True,  # Map the weights so the page cache can share and evict them
+                use_mlock=_should_mlock(self.model_path, self.kv_cache_bytes),  # Keep weights resident to avoid page-fault stalls during decode
+                f16_kv=True,  # Use half-precision for key/value cache
+                seed=42,  # Fixed seed for reproducibility
+                streaming=True  # invoke() still returns the full text
+                # Removed potentially problematic parameters
+            )
+
+        # Opt-in: the live context already reuses the previous prompt's prefix. The cache also
+        # restores older prefixes (the same chunks retrieved a few questions ago), but llama.cpp
+        # saves the full KV state after every completion, hundreds of MB copied per request
+        if self.kv_cache_bytes > 0:
+            llm.client.set_cache(LlamaRAMCache(capacity_bytes=self.kv_cache_bytes))
 
         self.console.print("[green]LLM model loaded successfully![/green]")
         return llm
 
-    def _load_streaming_llm(self):
+    def warmup(self) -> None:
+        """
+        Run a one-token completion and a zero-vector FAISS search so the first real query
+        doesn't pay for kernel setup and KV cache allocation.
+        """
+        with self._llm_lock:
+            self.llm.client("Warmup.", max_tokens=1)
+
+        vector_store = self.knowledge_base.vector_store
+        if vector_store is not None:
+            vector_store.index.search(np.zeros((1, vector_store.index.d), dtype=np.float32), 1)
+
+    def lookup_cached_response(self, query_embedding: Sequence[float]) -> Optional[Tuple[str, List[str]]]:
         """
-        Load a separate LLM instance configured for streaming.
+        Look up a cached answer to a similar earlier question.
+
+        Args:
+            query_embedding: Embedding of the user's question
 
         Returns:
-            Loaded LLM instance with streaming callbacks
+            Tuple of (response text, list of sources) on a hit, None otherwise
         """
-        # Create a streaming callback handler
-        streaming_handler = StreamingCallbackHandler()
-        callback_manager = CallbackManager([streaming_handler])
-
-        # Create a null device to discard stderr output temporarily
-        with open(os.devnull, 'w') as null_stderr:
-            with redirect_stderr(null_stderr):                streaming_llm = LlamaCpp(
-                    model_path=self.model_path,
-                    temperature=0.1,
-                    max_tokens=2048,
-                    n_ctx=4096,  # Reduced context size
-                    top_p=0.95,
-                    callback_manager=callback_manager,
-                    verbose=False,  # Disable verbose output for streaming
-                    n_gpu_layers=0,  # CPU-only mode for compatibility
-                    n_batch=512,
-                    f16_kv=True,
-                    seed=42,
-                    streaming=True  # Enable streaming!
-                )
-
-        return streaming_llm, streaming_handler
+        # Answers cached against an older knowledge base are discarded
+        self.semantic_cache.ensure_tag(self.knowledge_base.version)
+        return self.semantic_cache.lookup(query_embedding)
 
     def get_response(self, query: str) -> tuple[str, list[str]]:
         """
@@ -195,72 +269,74 @@ Answer: """
         if not self.knowledge_base.check_knowledge_base_exists():
             raise RuntimeError("Knowledge base not initialized. Please process PDFs first.")
 
+        query_embedding = self.knowledge_base.embedding_model.embed_query(query)
+        cached = self.lookup_cached_response(query_embedding)
+        if cached:
+            return cached
+
         # Retrieve documents from knowledge base
-        docs = self.knowledge_base.vector_store.similarity_search(query, k=4)
+        docs = [doc for doc, _ in self.knowledge_base.search_by_embedding(query_embedding, 4)]
         self.current_source_docs = docs
 
         # Format context from documents
-        context = "\n\n".join(doc.page_content for doc in docs)
+        context = _format_context(docs)
 
         # Format prompt with context and question
         prompt = self.qa_prompt.format(context=context, question=query)
 
         # Get response from LLM
-        result = self.llm.invoke(prompt)
+        with self._llm_lock:
+            result = self.llm.invoke(prompt)
 
-        # Get sources from the current docs
-        sources = []
-        if self.current_source_docs:
-            for doc in self.current_source_docs:
-                if "source" in doc.metadata:
-                    sources.append(doc.metadata["source"])
+        sources = _unique_sources(self.current_source_docs)
+        self.semantic_cache.add(query_embedding, result, sources)
+        return result, sources
+
+    async def aget_response(self, query: str) -> Tuple[str, List[str]]:
+        """
+        Get a response for a single query without blocking the event loop.
+
+        Args:
+            query: The user's question
 
-        return result, list(set(sources))
+        Returns:
+            Tuple of (response text, list of sources)
+        """
+        # Embedding, cache lookup, retrieval and generation all block, so run them in a worker thread
+        return await asyncio.to_thread(self.get_response, query)
 
-    async def get_streaming_response(self, query: str) -> AsyncIterator[Tuple[str, list[str]]]:
+    def fast_query(self, query: str, query_embedding: Optional[Sequence[float]] = None,
+                   k: int = 4) -> Tuple[Iterator[str], List[str]]:
         """
-        Get a streaming response for a query.
+        Answer a query by calling the embedder, FAISS and llama.cpp directly, bypassing LangChain.
 
         Args:
             query: The user's question
+            query_embedding: Optional precomputed embedding of the question
+            k: Number of chunks to retrieve
 
-        Yields:
-            Tuples of (token, list of sources)
+        Returns:
+            Tuple of (iterator over generated tokens, list of sources)
         """
         if not self.knowledge_base.check_knowledge_base_exists():
             raise RuntimeError("Knowledge base not initialized. Please process PDFs first.")
 
-        # Initialize streaming LLM on first use
-        if not self.streaming_llm:
-            self.streaming_llm, self.streaming_handler = self._load_streaming_llm()
-
-        # Retrieve documents from knowledge base
-        docs = self.knowledge_base.vector_store.similarity_search(query, k=4)
+        if query_embedding is None:
+            query_embedding = self.knowledge_base.embedding_model.embed_query(query)
+        docs = [doc for doc, _ in self.knowledge_base.search_by_embedding(query_embedding, k)]
         self.current_source_docs = docs
 
-        # Format context from documents
-        context = "\n\n".join(doc.page_content for doc in docs)
-
-        # Format prompt with context and question
+        context = _format_context(docs)
         prompt = self.qa_prompt.format(context=context, question=query)
 
-        # Start generating response (will push to the streaming handler)
-        # We don't need to await this as it will push tokens to the handler
-        asyncio.create_task(
-            asyncio.to_thread(self.streaming_llm.invoke, prompt)
-        )
-
-        # Get sources from the docs
-        sources = []
-        if self.current_source_docs:
-            for doc in self.current_source_docs:
-                if "source" in doc.metadata:
-                    sources.append(doc.metadata["source"])
-        unique_sources = list(set(sources))
+        def generate() -> Iterator[str]:
+            # One native streaming call into llama.cpp for the whole completion, with the same
+            # sampling parameters (repeat_penalty, top_k, stop, ...) LangChain passes in get_response
+            with self._llm_lock:
+                for chunk in self.llm.client(prompt, stream=True, **self.llm._get_parameters()):
+                    yield chunk["choices"][0]["text"]
 
-        # Stream tokens as they're generated
-        async for token in self.streaming_handler.get_tokens():
-            yield token, unique_sources
+        return generate(), _unique_sources(docs)
 
     def start_interactive_chat(self):
         """
@@ -280,11 +356,24 @@ Answer: """
 
             if not self.knowledge_base.check_knowledge_base_exists():
                 self.console.print("[bold red]Error:[/bold red] Knowledge base not initialized. Please process PDFs first.")
-                return            # Main chat loop
+                return
+
+            # Recall earlier questions with the arrow keys, including ones from past sessions
+            if readline is not None:
+                try:
+                    readline.read_history_file(INPUT_HISTORY_FILE)
+                except OSError:
+                    pass
+                readline.set_history_length(INPUT_HISTORY_LENGTH)
+                atexit.register(readline.write_history_file, INPUT_HISTORY_FILE)
+
+            # Warm up while the user types the first question; get_response waits on the model lock if needed
+            threading.Thread(target=self.warmup, daemon=True).start()
+
+            # Main chat loop
             while True:
                 # Get user input
-                self.console.print("[bold blue]You:[/bold blue]", end=" ")
-                user_input = input("")
+                user_input = input(INPUT_PROMPT)
                 user_input = user_input.strip()
 
                 # Check for exit commands
@@ -303,8 +392,9 @@ Answer: """
                     # Get response
                     response, sources = self.get_response(user_input)
 
-                # Add to message history
+                # Add to message history, keeping only the most recent turns
                 self.message_history.add_ai_message(response)
+                self.message_history.messages[:] = self.message_history.messages[-2 * MAX_HISTORY_TURNS:]
 
                 # Display response
                 self.console.print("\n[bold green]Assistant:[/bold green]", end=" ")
@@ -0,0 +1,94 @@
+"""
+Embedding cache module for reusing document vectors across knowledge base rebuilds
+"""
+
+import os
+import logging
+import hashlib
+from functools import lru_cache
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from src.file_utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Bump when the stored vector layout changes so stale files are never read back as hits
+CACHE_FORMAT_VERSION = 1
+
+class CachedEmbedder(Embeddings):
+    """Wraps an embedding model with an on-disk vector cache keyed by content hash."""
+
+    def __init__(self, embedder: Embeddings, model_id: str, cache_dir: str = "data/embeddings/cache",
+                 query_cache_size: int = 1024):
+        """
+        Initialize the cached embedder.
+
+        Args:
+            embedder: The underlying embedding model
+            model_id: Identifier of the embedding model and any encode settings that change its output,
+                mixed into every key so differently produced vectors are never shared
+            cache_dir: Directory to store cached vectors
+            query_cache_size: Number of recent query embeddings kept in memory
+        """
+        self.embedder = embedder
+        self.model_id = model_id
+        self.cache_dir = cache_dir
+        # Queries are short-lived and numerous, so they get an in-memory LRU rather than disk files
+        self._embed_query = lru_cache(maxsize=query_cache_size)(lambda text: tuple(embedder.embed_query(text)))
+
+    def _key(self, text: str) -> str:
+        """Hash the cache format version, model id and chunk text into a cache key"""
+        return hashlib.sha256(f"v{CACHE_FORMAT_VERSION}\0{self.model_id}\0{text}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        """Shard cache files by key prefix to keep directories small"""
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def _load(self, key: str) -> Optional[List[float]]:
+        """Load a cached vector, returning None on a miss"""
+        try:
+            return np.load(self._path(key)).tolist()
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, key: str, vector: List[float]) -> None:
+        """Persist a vector atomically so concurrent readers never see partial files"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path) as f:
+            np.save(f, np.asarray(vector, dtype=np.float32))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed document chunks, encoding only those not already cached.
+
+        Args:
+            texts: Chunk texts to embed
+
+        Returns:
+            List of embedding vectors in the same order as texts
+        """
+        keys = [self._key(text) for text in texts]
+        vectors = [self._load(key) for key in keys]
+
+        misses = [i for i, vector in enumerate(vectors) if vector is None]
+        if misses:
+            # Encode all misses in a single batched call
+            new_vectors = self.embedder.embed_documents([texts[i] for i in misses])
+            for i, vector in zip(misses, new_vectors):
+                vectors[i] = vector
+            try:
+                for i in misses:
+                    self._store(keys[i], vectors[i])
+            except OSError as e:
+                # Only a cache: a full or read-only disk must not abort the ingest
+                logger.warning("Could not cache embeddings in %s: %s", self.cache_dir, e)
+
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query, reusing the vector when the same text was asked recently"""
+        return list(self._embed_query(text))
@@ -0,0 +1,34 @@
+"""
+File helpers shared by the on-disk caches
+"""
+
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator
+
+@contextmanager
+def atomic_write(path: str) -> Iterator[BinaryIO]:
+    """
+    Open a unique temp file next to path for binary writing and move it over path once the block succeeds.
+
+    Concurrent writers never clobber each other's temp files and readers never see a partial file.
+    If the block or the final rename fails, the temp file is removed and the error re-raised.
+
+    Args:
+        path: Destination file path; its directory must already exist
+
+    Yields:
+        Binary file object to write the new contents to
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -3,28 +3,93 @@ Knowledge Base module for storing and retrieving document embeddings
 """
 
 import os
-from typing import List, Dict, Any, Optional
+import pickle
+import shutil
+import logging
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Sequence, Tuple
 from pathlib import Path
 
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
 from langchain_huggingface import HuggingFaceEmbeddings
 
+from src.embedding_cache import CachedEmbedder
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# Above this many vectors exact search is swapped for an approximate HNSW graph
+HNSW_MIN_VECTORS = 50_000
+# Storage precision of indexed vectors; anything but float32 uses a scalar quantizer
+SCALAR_QUANTIZER_TYPES = {
+    "float16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+# "pq" stores 8-bit product quantizer codes (one byte per 8 dimensions) in an inverted file;
+# below this many vectors there is too little data to train it and int8 is used instead
+IVFPQ_MIN_VECTORS = 10_000
+IVFPQ_NPROBE = 8
+# Squared L2 distance between unit vectors is 2 - 2*cosine, so 1.0 keeps chunks with cosine >= 0.5
+MAX_CONTEXT_DISTANCE = 1.0
+
+def _embedding_device() -> str:
+    """Device for the embedding model: CUDA when available, overridable via EMBEDDING_DEVICE"""
+    device = os.getenv("EMBEDDING_DEVICE")
+    if device:
+        return device
+    try:
+        import torch
+    except ImportError:
+        return "cpu"
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def _within_distance(results: List[Tuple[Document, float]],
+                     max_distance: Optional[float]) -> List[Tuple[Document, float]]:
+    """Drop weak matches beyond max_distance, always keeping the closest one"""
+    if max_distance is None:
+        return results
+    return results[:1] + [(doc, distance) for doc, distance in results[1:] if distance <= max_distance]
+
 class KnowledgeBase:
     """Manages the vector database for document retrieval."""
 
-    def __init__(self, embeddings_dir: str = "data/embeddings"):
+    def __init__(self, embeddings_dir: str = "data/embeddings", embedding_dtype: str = "float16",
+                 mmap_index: bool = False):
         """
         Initialize the knowledge base with a path to the embeddings directory.
 
         Args:
             embeddings_dir: Directory to store embeddings
+            embedding_dtype: Precision of vectors in new indexes ("float32", "float16", "int8" or "pq")
+            mmap_index: Memory-map the saved index read-only so server workers share its vector codes
         """
+        if embedding_dtype not in ("float32", "pq") and embedding_dtype not in SCALAR_QUANTIZER_TYPES:
+            raise ValueError(f"Unsupported embedding dtype: {embedding_dtype}")
+
         self.embeddings_dir = embeddings_dir
-        self.embedding_model = HuggingFaceEmbeddings(
-            model_name="all-MiniLM-L6-v2",
-            cache_folder="data/embeddings/models"
+        self.embedding_dtype = embedding_dtype
+        self.mmap_index = mmap_index
+        encode_kwargs = {"batch_size": 64, "normalize_embeddings": True}
+        # Chunk vectors are cached on disk so rebuilds only encode new or changed text
+        self.embedding_model = CachedEmbedder(
+            HuggingFaceEmbeddings(
+                model_name=EMBEDDING_MODEL_NAME,
+                cache_folder="data/embeddings/models",
+                model_kwargs={"device": _embedding_device()},
+                encode_kwargs=encode_kwargs
+            ),
+            # Normalization changes the stored vectors, so it is part of the cache identity
+            model_id=f"{EMBEDDING_MODEL_NAME}|normalize={encode_kwargs['normalize_embeddings']}",
+            cache_dir=os.path.join(embeddings_dir, "cache")
         )
         self.vector_store = None
+        self.version = None  # Changes whenever the saved index changes
 
         # Try to load existing vector store
         self._load_vector_store()
@@ -39,33 +104,91 @@ class KnowledgeBase:
         index_path = os.path.join(self.embeddings_dir, "faiss_index")
         if os.path.exists(index_path):
             try:
-                print(f"Found vector store at {index_path}")
-                print(f"Checking index files...")
+                logger.debug("Found vector store at %s, checking index files", index_path)
 
                 if not os.path.exists(os.path.join(index_path, "index.faiss")):
-                    print("Missing index.faiss file")
+                    logger.warning("Missing index.faiss file in %s", index_path)
                     return False
 
                 if not os.path.exists(os.path.join(index_path, "index.pkl")):
-                    print("Missing index.pkl file")
+                    logger.warning("Missing index.pkl file in %s", index_path)
                     return False
 
-                print("Loading vector store...")
-                self.vector_store = FAISS.load_local(
-                    index_path,
-                    self.embedding_model,
-                    allow_dangerous_deserialization=True
-                )
-                print("Vector store loaded successfully")
+                logger.debug("Loading vector store...")
+                self.vector_store = self._read_vector_store(index_path, mmap=self.mmap_index)
+                self.version = self._index_version(index_path)
+                logger.info("Vector store loaded successfully")
                 return True
             except Exception as e:
-                print(f"Error loading vector store: {str(e)}")
-                print(f"Error type: {type(e)}")
-                import traceback
-                print(f"Traceback: {traceback.format_exc()}")
+                logger.error("Error loading vector store: %s", e)
+                logger.debug("Traceback: %s", traceback.format_exc())
                 self.vector_store = None
                 return False
-        print(f"No vector store found at {index_path}")
+        logger.info("No vector store found at %s", index_path)
+        return False
+
+    @staticmethod
+    def _index_version(index_path: str) -> int:
+        """Version of the saved index, taken from its modification time"""
+        return os.stat(os.path.join(index_path, "index.faiss")).st_mtime_ns
+
+    def _read_vector_store(self, index_path: str, mmap: bool) -> FAISS:
+        """
+        Read a saved vector store, optionally memory-mapping the FAISS index.
+
+        Args:
+            index_path: Directory containing index.faiss and index.pkl
+            mmap: Whether to map the index read-only instead of copying it into RAM
+
+        Returns:
+            Loaded FAISS vector store
+        """
+        if not mmap:
+            return FAISS.load_local(
+                index_path,
+                self.embedding_model,
+                allow_dangerous_deserialization=True
+            )
+
+        # Mapped pages live in the shared page cache instead of each worker's heap. IO_FLAG_MMAP covers IVF
+        # inverted lists and IO_FLAG_MMAP_IFC (newer faiss) flat and scalar-quantized codes, including HNSW
+        # storage; HNSW links and the pickled docstore are still read into every worker
+        index = faiss.read_index(
+            os.path.join(index_path, "index.faiss"),
+            faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+        )
+        with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        return FAISS(
+            embedding_function=self.embedding_model,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id
+        )
+
+    def reload_if_changed(self) -> bool:
+        """
+        Reload the vector store if another process saved a newer index to disk.
+
+        Returns:
+            Boolean indicating if the vector store was reloaded
+        """
+        index_path = os.path.join(self.embeddings_dir, "faiss_index")
+        try:
+            version = self._index_version(index_path)
+            # _save_vector_store replaces index.faiss then index.pkl; wait until the pair is complete
+            if os.stat(os.path.join(index_path, "index.pkl")).st_mtime_ns < version:
+                return False
+        except OSError:
+            return False
+        if version == self.version:
+            return False
+
+        previous = self.vector_store
+        if self._load_vector_store():
+            return True
+        # Keep serving the old index if the new one was caught mid-write; retried next call
+        self.vector_store = previous
         return False
 
     def check_knowledge_base_exists(self) -> bool:
@@ -75,10 +198,53 @@ class KnowledgeBase:
         Returns:
             Boolean indicating if the knowledge base exists
         """
-        exists = self.vector_store is not None
-        #print(f"Knowledge base exists: {exists}")
-        #print(f"Vector store: {self.vector_store}")
-        return exists
+        return self.vector_store is not None
+
+    def _create_vector_store(self, dimension: int, num_vectors: int) -> FAISS:
+        """
+        Create an empty FAISS vector store sized for the number of vectors being indexed.
+
+        Args:
+            dimension: Embedding dimension
+            num_vectors: Number of vectors that will be added
+
+        Returns:
+            Empty FAISS vector store
+        """
+        # Embeddings are L2-normalized, so L2 ranking matches cosine ranking
+        if self.embedding_dtype == "pq" and num_vectors >= IVFPQ_MIN_VECTORS:
+            nlist = min(4096, 8 * int(np.sqrt(num_vectors)))
+            quantizer = faiss.IndexFlatL2(dimension)
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, dimension // 8, 8)
+            index.nprobe = IVFPQ_NPROBE
+        else:
+            qtype = SCALAR_QUANTIZER_TYPES.get("int8" if self.embedding_dtype == "pq" else self.embedding_dtype)
+            if num_vectors > HNSW_MIN_VECTORS:
+                if qtype is None:
+                    index = faiss.IndexHNSWFlat(dimension, 32)
+                else:
+                    index = faiss.IndexHNSWSQ(dimension, qtype, 32)
+                index.hnsw.efSearch = 64
+            elif qtype is None:
+                index = faiss.IndexFlatL2(dimension)
+            else:
+                index = faiss.IndexScalarQuantizer(dimension, qtype, faiss.METRIC_L2)
+
+        return FAISS(
+            embedding_function=self.embedding_model,
+            index=index,
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={}
+        )
+
+    def _copy_vector_store(self, vector_store: FAISS) -> FAISS:
+        """Independent copy of a vector store that can be extended while the original serves queries"""
+        return FAISS(
+            embedding_function=self.embedding_model,
+            index=faiss.clone_index(vector_store.index),
+            docstore=InMemoryDocstore(dict(vector_store.docstore._dict)),
+            index_to_docstore_id=dict(vector_store.index_to_docstore_id)
+        )
 
     def add_documents(self, documents: List[Dict[str, Any]], force_rebuild: bool = False) -> None:
         """
@@ -88,31 +254,145 @@ class KnowledgeBase:
             documents: List of document chunks to add
             force_rebuild: Whether to rebuild the knowledge base from scratch
         """
-        # If force rebuild is set or no existing vector store, create a new one
-        if force_rebuild or self.vector_store is None:
-            self.vector_store = FAISS.from_documents(documents, self.embedding_model)
-        else:
-            # Add documents to existing vector store
-            self.vector_store.add_documents(documents)
+        self.add_documents_batched(
+            [doc.page_content for doc in documents],
+            [doc.metadata for doc in documents],
+            force_rebuild=force_rebuild
+        )
+
+    def add_documents_batched(self, texts: List[str], metadatas: List[Dict[str, Any]],
+                              batch_size: int = 64, force_rebuild: bool = False) -> None:
+        """
+        Embed chunk texts in batches, add them to the knowledge base and save to disk.
+
+        Args:
+            texts: Chunk texts to add
+            metadatas: Metadata for each chunk, in the same order as texts
+            batch_size: Number of chunks encoded per embedding model call
+            force_rebuild: Whether to rebuild the knowledge base from scratch
+        """
+        if not texts:
+            return
+
+        def embed_batch(start: int) -> List[List[float]]:
+            # One encode call per batch rather than per chunk
+            return self.embedding_model.embed_documents(texts[start:start + batch_size])
+
+        starts = range(0, len(texts), batch_size)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            embeddings = embed_batch(starts[0])
+
+            # If force rebuild is set or no existing vector store, create a new one
+            index_path = os.path.join(self.embeddings_dir, "faiss_index")
+            vector_store = self.vector_store
+            if force_rebuild or vector_store is None:
+                vector_store = self._create_vector_store(len(embeddings[0]), len(texts))
+            elif self.mmap_index:
+                # A read-only mapped index can't grow; load a private writable copy to extend
+                vector_store = self._read_vector_store(index_path, mmap=False)
+            else:
+                # Queries keep searching the live store, so extend a copy rather than resizing it under them
+                vector_store = self._copy_vector_store(vector_store)
+
+            if not vector_store.index.is_trained:
+                # int8 and PQ quantizers learn their codebooks from every vector before any is added
+                for start in starts[1:]:
+                    embeddings.extend(embed_batch(start))
+                vector_store.index.train(np.asarray(embeddings, dtype=np.float32))
+                vector_store.add_embeddings(list(zip(texts, embeddings)), metadatas=metadatas)
+            else:
+                for start in starts:
+                    # Encode the next batch in the background while this one is added to the index
+                    upcoming = start + batch_size
+                    pending = executor.submit(embed_batch, upcoming) if upcoming < len(texts) else None
+                    vector_store.add_embeddings(
+                        list(zip(texts[start:upcoming], embeddings)),
+                        metadatas=metadatas[start:upcoming]
+                    )
+                    if pending is not None:
+                        embeddings = pending.result()
+
+        # Swap in only once populated so concurrent queries never see a half-built store
+        self.vector_store = vector_store
 
         # Save to disk
-        index_path = os.path.join(self.embeddings_dir, "faiss_index")
+        self._save_vector_store(self.vector_store, index_path)
+        self.version = self._index_version(index_path)
+
+    def _save_vector_store(self, vector_store: FAISS, index_path: str) -> None:
+        """
+        Save a vector store into a temporary directory, then move its files over the live ones.
+
+        Args:
+            vector_store: Vector store to save
+            index_path: Directory that should hold index.faiss and index.pkl
+        """
         os.makedirs(index_path, exist_ok=True)
-        self.vector_store.save_local(index_path)
+        tmp_dir = tempfile.mkdtemp(dir=self.embeddings_dir, prefix="faiss_index.")
+        try:
+            vector_store.save_local(tmp_dir)
+            # Each rename swaps in a new inode, so workers mapping the old file keep valid pages
+            # instead of seeing it rewritten underneath them (SIGBUS)
+            for name in ("index.faiss", "index.pkl"):
+                os.replace(os.path.join(tmp_dir, name), os.path.join(index_path, name))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
-    def query(self, question: str, top_k: int = 4) -> List[str]:
+    def query(self, question: str, top_k: int = 4,
+              max_distance: Optional[float] = MAX_CONTEXT_DISTANCE) -> List[str]:
         """
         Query the knowledge base to retrieve the most relevant document chunks.
 
         Args:
             question: The user question
-            top_k: Number of relevant chunks to retrieve
+            top_k: Maximum number of relevant chunks to retrieve
+            max_distance: Drop chunks further than this from the question (None keeps all top_k)
 
         Returns:
             List of document chunks as strings
         """
+        return [doc.page_content for doc, _ in self.search(question, top_k, max_distance)]
+
+    def search(self, question: str, top_k: int = 4,
+               max_distance: Optional[float] = MAX_CONTEXT_DISTANCE) -> List[Tuple[Document, float]]:
+        """
+        Retrieve the chunks most relevant to a question, skipping weak matches.
+
+        Args:
+            question: The user question
+            top_k: Maximum number of relevant chunks to retrieve
+            max_distance: Drop chunks further than this from the question (None keeps all top_k)
+
+        Returns:
+            List of (document, L2 distance) tuples, closest first
+        """
         if self.vector_store is None:
             return []
 
-        docs = self.vector_store.similarity_search(question, k=top_k)
-        return [doc.page_content for doc in docs]
+        return _within_distance(self.vector_store.similarity_search_with_score(question, k=top_k), max_distance)
+
+    def search_by_embedding(self, embedding: Sequence[float], top_k: int = 4,
+                            max_distance: Optional[float] = MAX_CONTEXT_DISTANCE) -> List[Tuple[Document, float]]:
+        """
+        Search the FAISS index directly with a precomputed query embedding.
+
+        Args:
+            embedding: Query embedding
+            top_k: Maximum number of relevant chunks to retrieve
+            max_distance: Drop chunks further than this from the query (None keeps all top_k)
+
+        Returns:
+            List of (document, L2 distance) tuples, closest first
+        """
+        vector_store = self.vector_store
+        if vector_store is None:
+            return []
+
+        distances, ids = vector_store.index.search(np.asarray([embedding], dtype=np.float32), top_k)
+        results = []
+        for distance, i in zip(distances[0], ids[0]):
+            if i == -1:  # Fewer than top_k vectors indexed
+                continue
+            doc = vector_store.docstore.search(vector_store.index_to_docstore_id[i])
+            results.append((doc, float(distance)))
+        return _within_distance(results, max_distance)
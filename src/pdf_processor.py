@@ -3,32 +3,244 @@ PDF Processor module for extracting and processing text from PDF documents
 """
 
 import os
-from pathlib import Path
-from typing import List, Dict, Any
+import sys
+import logging
+import pickle
+import hashlib
+import multiprocessing
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Iterator, NamedTuple, Optional, Tuple
 from tqdm import tqdm
 
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import pypdfium2 as pdfium
+from semantic_text_splitter import TextSplitter
+
+from src.file_utils import atomic_write
+
+class Chunk(NamedTuple):
+    """A piece of PDF text with its metadata, exposing the same fields callers read from a Document."""
+    page_content: str
+    metadata: Dict[str, Any]
+
+    def to_document(self):
+        """Convert to a LangChain Document for APIs that require one"""
+        from langchain_core.documents import Document
+        return Document(page_content=self.page_content, metadata=self.metadata)
+
+logger = logging.getLogger(__name__)
+
+# Callers (the API server) run threads, torch and llama.cpp; forking them can deadlock the children.
+# Spawned children still re-run the launching script's imports, so main.py keeps heavy ones in its commands
+_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+# A PDF with at least this many pages has its pages extracted in parallel when parsed on its own
+PARALLEL_MIN_PAGES = 200
+
+# How many PDFs ahead of the one being parsed have readahead queued when parsing sequentially
+PREFETCH_SEQUENTIAL_FILES = 2
+
+# Bump when Chunk or the splitting output changes so stale pickles are never read back as hits
+CHUNK_CACHE_VERSION = 1
+
+# One splitter per worker process, reused for every PDF it parses
+_splitters: Dict[Tuple[int, int], TextSplitter] = {}
+
+def _get_splitter(chunk_size: int, chunk_overlap: int) -> TextSplitter:
+    """Create the text splitter for these chunk parameters once per process"""
+    key = (chunk_size, chunk_overlap)
+    if key not in _splitters:
+        # Native recursive splitter: paragraphs, then lines, sentences and words, in Rust
+        _splitters[key] = TextSplitter(chunk_size, overlap=chunk_overlap)
+    return _splitters[key]
+
+@lru_cache(maxsize=32)
+def _list_pdfs(directory_path: str, dir_mtime: int) -> Tuple[str, ...]:
+    """Sorted PDF paths in a directory; dir_mtime is only part of the cache key"""
+    # One scandir pass; dirent type info avoids a stat per entry for regular files
+    with os.scandir(directory_path) as entries:
+        return tuple(sorted(
+            entry.path for entry in entries
+            if entry.name.lower().endswith(".pdf") and entry.is_file()
+        ))
+
+def _prefetch(paths: List[str]) -> None:
+    """Ask the kernel to start reading the given PDFs into the page cache (POSIX only)"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+def _page_text(pdf: pdfium.PdfDocument, index: int) -> str:
+    """Extract one page's text, releasing the PDFium page handles straight away"""
+    page = pdf[index]
+    textpage = page.get_textpage()
+    text = textpage.get_text_range()
+    textpage.close()
+    page.close()
+    return text
+
+def _extract_page_texts(args: Tuple[str, int, int]) -> List[str]:
+    """Extract the text of pages [start, stop) of a PDF in a worker process"""
+    pdf_path, start, stop = args
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return [_page_text(pdf, index) for index in range(start, stop)]
+    finally:
+        pdf.close()
+
+def _iter_page_texts(pdf_path: str, pdf: pdfium.PdfDocument, page_workers: int = 1) -> Iterator[str]:
+    """Yield the text of every page of an open PDF in order, fanning large PDFs out over page_workers processes"""
+    page_count = len(pdf)
+    if page_workers <= 1 or page_count < PARALLEL_MIN_PAGES:
+        for index in range(page_count):
+            yield _page_text(pdf, index)
+        return
+
+    # PDFium serializes calls across threads, so each process opens the file and takes a page range
+    step = -(-page_count // page_workers)
+    ranges = [(pdf_path, start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=_MP_CONTEXT) as pool:
+        for texts in pool.map(_extract_page_texts, ranges):
+            yield from texts
+
+def _iter_pages(pdf_path: str, pdf: pdfium.PdfDocument, source: str, page_workers: int = 1) -> Iterator[Chunk]:
+    """Extract each page's text with PDFium, yielding one Chunk per page"""
+    for page_number, text in enumerate(_iter_page_texts(pdf_path, pdf, page_workers)):
+        yield Chunk(text, {"source": source, "page": page_number})
+
+def _file_digest(pdf_path: str) -> str:
+    """SHA-256 of a file's contents"""
+    with open(pdf_path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+        return digest.hexdigest()
+
+def _page_chunks(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """Split one page's text, skipping the splitter for pages that already fit in a chunk"""
+    if len(text) <= chunk_size:
+        # Matches the splitter's output for short text: trimmed, and nothing for a blank page
+        text = text.strip()
+        return [text] if text else []
+    return _get_splitter(chunk_size, chunk_overlap).chunks(text)
+
+def _split_pdf(pdf_path: str, source: str, chunk_size: int, chunk_overlap: int,
+               page_workers: int = 1) -> List[Chunk]:
+    """Extract and split a PDF's pages into chunks"""
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        # Split each page as it is extracted, so the full page list is never held alongside the chunks.
+        # PDFium extracts text in native code, several times faster than pypdf.
+        # A page's chunks share its metadata dict (built once, never mutated), which also pickles once
+        return [
+            Chunk(chunk, page.metadata)
+            for page in _iter_pages(pdf_path, pdf, source, page_workers)
+            for chunk in _page_chunks(page.page_content, chunk_size, chunk_overlap)
+        ]
+    finally:
+        pdf.close()
+
+def _process_pdf(pdf_path: str, chunk_size: int, chunk_overlap: int, cache_dir: Optional[str] = None,
+                 page_workers: int = 1) -> List[Chunk]:
+    """
+    Load and split a single PDF. Module-level so it can be pickled into worker processes.
+
+    Args:
+        pdf_path: Path to the PDF file
+        chunk_size: The size of text chunks in characters
+        chunk_overlap: The overlap between chunks in characters
+        cache_dir: Optional directory of chunk lists from earlier runs, keyed by file content
+        page_workers: Processes to spread the pages of a large PDF over (1 inside pool workers)
+
+    Returns:
+        List of document chunks with text and metadata
+    """
+    try:
+        # Source filename for metadata; every chunk shares one interned string,
+        # which also pickles once and keeps source dedup to identity comparisons
+        source = sys.intern(os.path.basename(pdf_path))
+        if cache_dir is None:
+            return _split_pdf(pdf_path, source, chunk_size, chunk_overlap, page_workers)
+
+        digest = _file_digest(pdf_path)
+        # Content PDFium rejected in an earlier run would be rejected again, so don't reparse it
+        failed_path = os.path.join(cache_dir, f"{digest}.failed")
+        if os.path.exists(failed_path):
+            logger.warning("Skipping %s: it could not be parsed in an earlier run", pdf_path)
+            return []
+
+        cache_path = os.path.join(
+            cache_dir, f"v{CHUNK_CACHE_VERSION}-{digest}-{chunk_size}-{chunk_overlap}.pkl"
+        )
+        try:
+            with open(cache_path, "rb") as f:
+                documents = pickle.load(f)
+            # The same content may have been cached under another filename
+            if documents and documents[0].metadata["source"] != source:
+                for doc in documents:
+                    doc.metadata["source"] = source
+            return documents
+        except Exception:
+            pass  # Missing or unreadable entry; parse the PDF again
+
+        try:
+            documents = _split_pdf(pdf_path, source, chunk_size, chunk_overlap, page_workers)
+        except pdfium.PdfiumError:
+            # Remember the corrupt content, keyed by hash so a fixed file is retried
+            os.makedirs(cache_dir, exist_ok=True)
+            open(failed_path, "w").close()
+            raise
+
+        # The cache is only an optimization; a full or read-only disk must not drop the PDF
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write atomically so a concurrent or interrupted run never leaves a partial entry
+            with atomic_write(cache_path) as f:
+                pickle.dump(documents, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            logger.warning("Could not cache chunks of %s: %s", pdf_path, e)
+        return documents
+
+    except Exception:
+        logger.exception("Error processing %s", pdf_path)
+        return []
+
+def _process_pdf_worker(args: Tuple[str, int, int, Optional[str], int]) -> List[Chunk]:
+    """Unpack a (path, chunk_size, chunk_overlap, cache_dir, page_workers) task for the process pool"""
+    return _process_pdf(*args)
 
 class PDFProcessor:
     """Handles the loading and processing of PDF documents."""
 
-    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
+    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200, max_workers: Optional[int] = None,
+                 use_cache: bool = True, cache_dir: str = "data/chunk_cache"):
         """
         Initialize the PDF processor with configurable chunk parameters.
 
         Args:
             chunk_size: The size of text chunks in characters
             chunk_overlap: The overlap between chunks in characters
+            max_workers: Number of processes parsing PDFs in parallel (defaults to all cores but one)
+            use_cache: Whether to reuse chunks of PDFs whose content hasn't changed since an earlier run
+            cache_dir: Directory to store cached chunk lists
         """
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap
-        )
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.cache_dir = cache_dir if use_cache else None
+        self.text_splitter = _get_splitter(self.chunk_size, self.chunk_overlap)
 
-    def process_pdf(self, pdf_path: str) -> List[Dict[str, Any]]:
+    def process_pdf(self, pdf_path: str) -> List[Chunk]:
         """
         Process a single PDF file and return a list of document chunks.
 
@@ -38,24 +250,11 @@ class PDFProcessor:
         Returns:
             List of document chunks with text and metadata
         """
-        try:
-            loader = PyPDFLoader(pdf_path)
-            documents = loader.load()
-
-            # Add source filename to metadata
-            for doc in documents:
-                doc.metadata["source"] = os.path.basename(pdf_path)
-
-            # Split documents into chunks
-            split_docs = self.text_splitter.split_documents(documents)
-
-            return split_docs
-
-        except Exception as e:
-            print(f"Error processing {pdf_path}: {e}")
-            return []
+        return _process_pdf(
+            pdf_path, self.chunk_size, self.chunk_overlap, self.cache_dir, self.max_workers
+        )
 
-    def process_directory(self, directory_path: str) -> List[Dict[str, Any]]:
+    def process_directory(self, directory_path: str) -> List[Chunk]:
         """
         Process all PDF files in a directory.
 
@@ -65,11 +264,35 @@ class PDFProcessor:
         Returns:
             List of all document chunks from all PDFs
         """
-        pdf_files = list(Path(directory_path).glob("*.pdf"))
+        # Reuses the last listing while the directory's mtime (bumped on add/remove/rename) is unchanged
+        pdf_files = list(_list_pdfs(directory_path, os.stat(directory_path).st_mtime_ns))
         all_documents = []
 
-        for pdf_file in tqdm(pdf_files, desc="Processing PDFs"):
-            documents = self.process_pdf(str(pdf_file))
-            all_documents.extend(documents)
+        workers = min(self.max_workers, len(pdf_files))
+        if workers <= 1:
+            # Keep readahead a couple of files ahead so it overlaps parsing without flooding the page cache
+            window = PREFETCH_SEQUENTIAL_FILES
+            _prefetch(pdf_files[:window])
+            for index, pdf_file in enumerate(tqdm(pdf_files, desc="Processing PDFs")):
+                _prefetch(pdf_files[index + window:index + window + 1])
+                all_documents.extend(self.process_pdf(pdf_file))
+            return all_documents
+
+        # PDFium serializes calls across threads, so only processes parse PDFs in parallel
+        tasks = [
+            (pdf_file, self.chunk_size, self.chunk_overlap, self.cache_dir, 1)
+            for pdf_file in pdf_files
+        ]
+        # Hand each worker several small PDFs at a time to amortize the pickling round trips
+        chunksize = max(1, len(tasks) // (workers * 4))
+        # Read ahead roughly two batches per worker and slide the window as results come back,
+        # so a corpus larger than free RAM is not evicted before the workers reach it
+        window = 2 * workers * chunksize
+        _prefetch(pdf_files[:window])
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_MP_CONTEXT) as pool:
+            results = pool.map(_process_pdf_worker, tasks, chunksize=chunksize)
+            for index, documents in enumerate(tqdm(results, total=len(tasks), desc="Processing PDFs")):
+                _prefetch(pdf_files[index + window:index + window + 1])
+                all_documents.extend(documents)
 
         return all_documents
@@ -0,0 +1,206 @@
+"""
+Semantic cache module for reusing answers to repeated or paraphrased questions
+"""
+
+import os
+import json
+import atexit
+import logging
+import threading
+from typing import Any, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+from src.file_utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+class SemanticCache:
+    """Caches (answer, sources) responses keyed by query embedding, matched by cosine similarity."""
+
+    def __init__(self, threshold: float = 0.92, max_entries: int = 5000, persist_dir: Optional[str] = None,
+                 save_delay: float = 30.0):
+        """
+        Initialize the semantic cache, restoring saved entries if a persist directory is given.
+
+        Args:
+            threshold: Minimum cosine similarity for a cached query to count as a hit
+            max_entries: Maximum number of cached responses before the least recently used is evicted
+            persist_dir: Optional directory to save the cache to
+            save_delay: Seconds to batch changes for before saving them together
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.persist_dir = persist_dir
+        self.tag = None  # Identifies the knowledge base the cached answers came from
+        self.index = None  # Created on first add, once the embedding dimension is known
+        self.responses: List[Tuple[str, List[str]]] = []
+        self.last_used: List[int] = []
+        self._clock = 0
+        self.save_delay = save_delay
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # Orders writes; never held while lookups need _lock
+        self._save_timer: Optional[threading.Timer] = None
+        self._dirty = False
+
+        if persist_dir:
+            self._load()
+            # Write out whatever the last debounce window didn't
+            atexit.register(self.flush)
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        """L2-normalize an embedding so inner product equals cosine similarity"""
+        vector = np.asarray(embedding, dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def ensure_tag(self, tag: Any) -> None:
+        """
+        Drop all entries if they were cached against a different knowledge base.
+
+        Args:
+            tag: Identifier of the current knowledge base (e.g. its version)
+        """
+        with self._lock:
+            if self.tag == tag:
+                return
+            self._reset()
+            self.tag = tag
+            self._schedule_save()
+
+    def lookup(self, embedding: Sequence[float], threshold: Optional[float] = None) -> Optional[Tuple[str, List[str]]]:
+        """
+        Find the cached response for the most similar previous query.
+
+        Args:
+            embedding: Embedding of the incoming query
+            threshold: Optional override of the similarity threshold
+
+        Returns:
+            Tuple of (answer, sources) on a hit, None on a miss
+        """
+        threshold = self.threshold if threshold is None else threshold
+        vector = self._normalize(embedding)
+
+        with self._lock:
+            if self.index is None or self.index.ntotal == 0:
+                return None
+
+            scores, ids = self.index.search(vector, 1)
+            position = int(ids[0][0])
+            if position < 0 or scores[0][0] < threshold:
+                return None
+
+            self._clock += 1
+            self.last_used[position] = self._clock
+            return self.responses[position]
+
+    def add(self, embedding: Sequence[float], answer: str, sources: Sequence[str]) -> None:
+        """
+        Store a response for a query, evicting the least recently used entry when full.
+
+        Args:
+            embedding: Embedding of the query that produced the response
+            answer: The generated answer
+            sources: Sources cited by the answer
+        """
+        vector = self._normalize(embedding)
+
+        with self._lock:
+            if self.index is None:
+                self.index = faiss.IndexFlatIP(vector.shape[1])
+
+            if self.index.ntotal >= self.max_entries:
+                self._evict()
+
+            self.index.add(vector)
+            self.responses.append((answer, list(sources)))
+            self._clock += 1
+            self.last_used.append(self._clock)
+            self._schedule_save()
+
+    def _evict(self) -> None:
+        """Remove the least recently used entry (caller must hold the lock)"""
+        position = int(np.argmin(self.last_used))
+        # IndexFlat compacts in order on removal, so positions stay aligned with the lists
+        self.index.remove_ids(np.array([position], dtype="int64"))
+        del self.responses[position]
+        del self.last_used[position]
+
+    def _reset(self) -> None:
+        """Drop all entries (caller must hold the lock)"""
+        self.index = None
+        self.responses = []
+        self.last_used = []
+
+    def clear(self) -> None:
+        """Drop all cached responses, e.g. after the knowledge base is rebuilt"""
+        with self._lock:
+            self._reset()
+            self._schedule_save()
+
+    def _schedule_save(self) -> None:
+        """Mark the cache changed and start the debounce timer if none is pending (caller must hold the lock)"""
+        if not self.persist_dir:
+            return
+        self._dirty = True
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(self.save_delay, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self) -> None:
+        """Save pending changes now; errors are logged rather than raised"""
+        with self._save_lock:
+            # Snapshot under the lock, then write without blocking lookups
+            with self._lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                index_bytes = faiss.serialize_index(self.index) if self.index is not None else None
+                metadata = {"tag": self.tag, "responses": list(self.responses), "last_used": list(self.last_used)}
+
+            try:
+                self._save(index_bytes, metadata)
+            except (OSError, TypeError, ValueError) as e:
+                logger.warning("Could not save semantic cache to %s: %s", self.persist_dir, e)
+
+    def _save(self, index_bytes: Optional[np.ndarray], metadata: dict) -> None:
+        """Persist a snapshot of the index and sidecar metadata"""
+        os.makedirs(self.persist_dir, exist_ok=True)
+        index_path = os.path.join(self.persist_dir, "index.faiss")
+        if index_bytes is not None:
+            with atomic_write(index_path) as f:
+                f.write(index_bytes.tobytes())
+        elif os.path.exists(index_path):
+            os.remove(index_path)
+
+        metadata_path = os.path.join(self.persist_dir, "responses.json")
+        with atomic_write(metadata_path) as f:
+            f.write(json.dumps(metadata).encode("utf-8"))
+
+    def _load(self) -> None:
+        """Restore a previously saved cache, starting empty if it is missing or inconsistent"""
+        index_path = os.path.join(self.persist_dir, "index.faiss")
+        metadata_path = os.path.join(self.persist_dir, "responses.json")
+        try:
+            with open(metadata_path, encoding="utf-8") as f:
+                metadata = json.load(f)
+            index = faiss.read_index(index_path) if os.path.exists(index_path) else None
+        except (OSError, ValueError, RuntimeError):
+            return
+
+        responses = [(answer, sources) for answer, sources in metadata["responses"]]
+        if len(responses) != (index.ntotal if index is not None else 0):
+            return
+
+        self.tag = metadata["tag"]
+        self.index = index
+        self.responses = responses
+        self.last_used = metadata["last_used"]
+        self._clock = max(self.last_used, default=0)